@@ -0,0 +1,198 @@
+#####################################################################################################
+# Query helpers for analysing decoded activities from notebooks.
+#
+# Pulling the record stream of an activity out of Mongo is slow and analysts tend to load the same
+# few activities over and over.  ActivityQuery returns typed pandas data frames and keeps the record
+# stream of each activity in a local Parquet file so repeated runs read from disk instead of Mongo.
+#
+#   from activity_query import ActivityQuery
+#   from main import get_settings
+#   query = ActivityQuery(get_settings('full'))
+#   rides = query.get_activities({'sport': 'cycling'})
+#   records = query.get_records('12379160600', ['timestamp', 'power', 'heart_rate'],
+#                               start='2021-07-01 10:00:00', end='2021-07-01 11:00:00')
+#
+# The cache is limited in size.  When it grows past query_cache_size_mb the least recently used
+# activities are removed.  Cached activities are discarded when the ingest manifest written by
+# main.py shows the activity (or the whole collection) was loaded after the cache file was written,
+# or when invalidate() is called for the activity.  While an ingest is running, or after one failed,
+# the cache is neither read nor written and records come straight from Mongo.
+#
+# The following optional settings control the cache.
+# query_cache_directory - location of the Parquet cache.  Defaults to "query_cache".
+# query_cache_size_mb - maximum size of the cache in megabytes.  Defaults to 1024.
+#
+# Parquet files are written by pandas and require pyarrow (or fastparquet) to be installed.
+###############################################################################################
+
+import logging
+import os
+import time
+import pandas as pd
+from main import connect_to_mongo, read_ingest_manifest
+
+RECORD_MESG_NUM = 20
+SESSION_MESG_NUM = 18
+DEFAULT_CACHE_DIRECTORY = 'query_cache'
+DEFAULT_CACHE_SIZE_MB = 1024
+STRING_COLUMNS = ('activity_id',)
+
+
+class ActivityQuery:
+
+    def __init__(self, settings, db=None):
+        """
+        :param settings: settings loaded with get_settings() from main.py
+        :param db: optional database from connect_to_mongo().  Connected on first use when omitted.
+        """
+        self.settings = settings
+        self.db = db
+        self.cache_directory = os.path.join(settings.get('query_cache_directory', DEFAULT_CACHE_DIRECTORY),
+                                            settings['collection_name'])
+        self.cache_size = int(settings.get('query_cache_size_mb', DEFAULT_CACHE_SIZE_MB)) * 1024 * 1024
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+    def get_collection(self):
+        if self.db is None:
+            self.db = connect_to_mongo(self.settings)
+        return self.db[self.settings['collection_name']]
+
+    def get_activities(self, activity_filter=None):
+        """
+        Returns one row per activity built from the session messages.  This is a single small query
+        and is not cached.
+        :param activity_filter: mongo filter applied to the session messages, e.g. {'sport': 'cycling'}
+        :return: typed data frame sorted by activity_id
+        """
+        query = dict(message_type='FitDataMessage', message_global_mesg_num=SESSION_MESG_NUM)
+        if activity_filter:
+            query.update(activity_filter)
+
+        data_frame = type_data_frame(pd.DataFrame(list(self.get_collection().find(query, {'_id': 0}))))
+        if 'activity_id' in data_frame:
+            data_frame = data_frame.sort_values('activity_id').reset_index(drop=True)
+        return data_frame
+
+    def get_records(self, activity_id, fields=None, start=None, end=None):
+        """
+        Returns the record messages of an activity, reading from the local cache when possible.
+        :param activity_id: activity id as stored by main.py
+        :param fields: list of columns to return.  All columns when None.
+        :param start: optional first timestamp (datetime or string) to include
+        :param end: optional last timestamp (datetime or string) to include
+        :return: typed data frame sorted by record_id
+        """
+        activity_id = str(activity_id)
+        manifest = read_ingest_manifest(self.settings)
+        data_frame = self.read_cache(activity_id, manifest)
+        if data_frame is None:
+            query = dict(activity_id=activity_id, message_type='FitDataMessage',
+                         message_global_mesg_num=RECORD_MESG_NUM)
+            data_frame = type_data_frame(pd.DataFrame(list(self.get_collection().find(query, {'_id': 0}))))
+            if 'record_id' in data_frame:
+                data_frame = data_frame.sort_values('record_id').reset_index(drop=True)
+            if manifest['ingest_started_at'] is None:
+                self.write_cache(activity_id, data_frame)
+
+        if (start is not None or end is not None) and 'timestamp' in data_frame:
+            if start is not None:
+                data_frame = data_frame[data_frame['timestamp'] >= to_timestamp(start)]
+            if end is not None:
+                data_frame = data_frame[data_frame['timestamp'] <= to_timestamp(end)]
+
+        if fields is not None:
+            missing_fields = [field for field in fields if field not in data_frame]
+            if missing_fields:
+                logging.error('get_records(): Fields %s not found for activity %s', missing_fields, activity_id)
+            data_frame = data_frame[[field for field in fields if field in data_frame]]
+
+        return data_frame.reset_index(drop=True)
+
+    def cache_file_name(self, activity_id):
+        return os.path.join(self.cache_directory, activity_id + '.parquet')
+
+    def read_cache(self, activity_id, manifest):
+        cache_file = self.cache_file_name(activity_id)
+        if not os.path.exists(cache_file):
+            return None
+
+        if manifest['ingest_started_at'] is not None:
+            # the collection may be empty or partly loaded
+            logging.info('read_cache(): Ingest started at %s has not finished, reading activity %s from Mongo',
+                         manifest['ingest_started_at'], activity_id)
+            return None
+
+        ingested_at = max(manifest['reloaded_at'], manifest['activities'].get(activity_id, 0))
+        cached_at = os.stat(cache_file).st_mtime
+        if ingested_at >= cached_at:
+            self.invalidate(activity_id)
+            return None
+
+        # The access time drives LRU eviction.  The modified time is left as the time the file was
+        # written so it can still be compared with the manifest.
+        os.utime(cache_file, (time.time(), cached_at))
+        return pd.read_parquet(cache_file)
+
+    def write_cache(self, activity_id, data_frame):
+        data_frame.to_parquet(self.cache_file_name(activity_id), index=False)
+        self.evict()
+
+    def invalidate(self, activity_id=None):
+        """
+        Removes an activity from the cache, or every activity when activity_id is None.
+        """
+        if activity_id is None:
+            cache_files = [os.path.join(self.cache_directory, file) for file in os.listdir(self.cache_directory)
+                           if file.endswith('.parquet')]
+        else:
+            cache_files = [self.cache_file_name(str(activity_id))]
+
+        for cache_file in cache_files:
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+
+    def evict(self):
+        cache_files = []
+        for file in os.listdir(self.cache_directory):
+            if file.endswith('.parquet'):
+                file_stat = os.stat(os.path.join(self.cache_directory, file))
+                cache_files.append((file_stat.st_atime, file_stat.st_size, file))
+
+        cache_size = sum(size for access_time, size, file in cache_files)
+        for access_time, size, file in sorted(cache_files):
+            if cache_size <= self.cache_size:
+                break
+            os.remove(os.path.join(self.cache_directory, file))
+            cache_size -= size
+
+
+def to_timestamp(value):
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp
+
+
+def type_data_frame(data_frame):
+    """
+    Converts the values written by process_value() in main.py back into typed columns.  'None' strings
+    become missing values, timestamps become UTC datetimes and columns that hold only numbers become
+    numeric.  Remaining columns are stored as strings so they can be written to Parquet.  Id columns
+    keep the string values used by Mongo and the ingest manifest.
+    """
+    data_frame = data_frame.replace('None', float('nan'))
+    for column in data_frame.columns:
+        if data_frame[column].dtype != object:
+            continue
+        if column in ('timestamp', 'local_timestamp', 'start_time'):
+            # local times are written without a utc offset and end with a trailing space
+            data_frame[column] = pd.to_datetime(data_frame[column].str.strip(), utc=True, errors='coerce')
+            continue
+        if column in STRING_COLUMNS or column.startswith('message_'):
+            data_frame[column] = data_frame[column].astype('string')
+            continue
+        try:
+            data_frame[column] = pd.to_numeric(data_frame[column])
+        except (ValueError, TypeError):
+            data_frame[column] = data_frame[column].astype('string')
+    return data_frame
@@ -44,10 +44,18 @@
 # fileType - The extension of the fit data files. Usually ".fit"
 # debug - Turns on or off debug messages. Set to "True" to enable debugging otherwise set to "False"
 # db_insert - Enables database or JSON output.  Set to "db" for mongo db records. Set to "Full" for JSON.
+#                   Set to "sqlite" to write to a local SQLite database instead of MongoDB (see sqlite_sink.py).
 # document_skip - This features skips records to reduce processing type.  Useful for debugging.
 #                   Set to 1 to process all records.  Often set to 100 for debugging.
 # collection_name - collection name where MongoDB records will be inserted.
 # mongo_db_string - connection string for mongo database.  Use "localhost" for local database
+# manifest_file - optional. JSON file recording when each activity was last ingested into MongoDB.
+#                   Defaults to "ingest_manifest.json".  activity_query.py uses it to invalidate its local
+#                   cache.  SQLite loads do not update it.
+#
+# Ingest can be profiled by adding --profile to the command line.  Each worker then runs cProfile
+# and the parent merges the worker stats into a hotspot report and a flamegraph collapsed-stack file.
+# See profiling.py for the files written and the remaining profile options.
 #
 ###############################################################################################
 
@@ -65,9 +73,17 @@ import sys
 import json
 import multiprocessing as mp
 import itertools
+import profiling
+import sqlite_sink
 
 FULL = 'full'
 DB = 'db'
+SQLITE = 'sqlite'
+DEFAULT_MANIFEST_FILE = 'ingest_manifest.json'
+
+# Set in each pool worker by init_worker()
+worker_configuration_set = 'full'
+worker_record_queue = None
 
 
 def process_FitDefinitionMessage(FitDefinitionMessage_object):
@@ -121,6 +137,21 @@ def process_FieldDefinition_list_for_db(FieldDefinition_list_object, scope=FULL)
     return FieldDefinition_list
 
 
+def process_FieldDefinition_list_for_sqlite(FieldDefinition_list_object):
+    """
+    Field types for the SQLite sink.  fitdecode applies scale and offset while decoding, so those fields
+    hold floats whatever their base type is and are reported as 'scaled'.
+    :param FieldDefinition_list_object:
+    :return: dict of field name to type
+    """
+    FieldDefinition_list = process_FieldDefinition_list_for_db(FieldDefinition_list_object)
+    for FieldDefinition_object in FieldDefinition_list_object:
+        field = FieldDefinition_object.field
+        if field is not None and ((field.scale and field.scale != 1) or field.offset):
+            FieldDefinition_list[FieldDefinition_object.name] = 'scaled'
+    return FieldDefinition_list
+
+
 def process_FieldDefinition(FieldDefinition_object, scope=FULL):
     if FieldDefinition_object is None or FieldDefinition_object == 'None':
         FieldDefinition_dict = None
@@ -467,6 +498,65 @@ def configure_logging():
                         datefmt='%m/%d/%Y %I:%M:%S %p')
 
 
+def load_ingest_manifest(settings):
+    manifest_file = settings.get('manifest_file', DEFAULT_MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    collection_manifest = manifest.setdefault(settings['collection_name'], {})
+    collection_manifest.setdefault('reloaded_at', 0)
+    collection_manifest.setdefault('ingest_started_at', None)
+    collection_manifest.setdefault('activities', {})
+    return manifest, collection_manifest
+
+
+def save_ingest_manifest(settings, manifest):
+    with open(settings.get('manifest_file', DEFAULT_MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_ingest_manifest(settings):
+    """
+    Returns the ingest manifest entry for the configured collection as a dict with reloaded_at,
+    ingest_started_at (None unless an ingest is running or failed) and activities (activity id to
+    ingest time) keys.
+    """
+    return load_ingest_manifest(settings)[1]
+
+
+def start_ingest_manifest(settings, start_time):
+    """
+    Marks an ingest as in progress before the collection is changed.  The mark is only cleared by
+    write_ingest_manifest() once the ingest has finished, so a failed ingest leaves every cached query
+    result invalid.
+    :param start_time: time.time() before the collection is reset
+    """
+    manifest, collection_manifest = load_ingest_manifest(settings)
+    collection_manifest['ingest_started_at'] = start_time
+    if settings['reloadDB']:
+        collection_manifest['reloaded_at'] = start_time
+        collection_manifest['activities'] = {}
+    save_ingest_manifest(settings, manifest)
+
+
+def write_ingest_manifest(settings, activity_ids, ingest_time):
+    """
+    Records the ingest time of each activity so cached query results older than the ingest can be
+    discarded.  A reload of the collection invalidates every activity of that collection.
+    :param activity_ids: activity ids processed by this run
+    :param ingest_time: time.time() once the ingest has finished.  Records are inserted over the whole run,
+                        so anything cached before the end may be partial.
+    """
+    manifest, collection_manifest = load_ingest_manifest(settings)
+    collection_manifest['ingest_started_at'] = None
+    if settings['reloadDB']:
+        collection_manifest['reloaded_at'] = ingest_time
+    for activity_id in activity_ids:
+        collection_manifest['activities'][activity_id] = ingest_time
+    save_ingest_manifest(settings, manifest)
+
+
 def get_settings(configuration_set):
     with open('settings.json', 'r') as f:
         config = json.load(f)
@@ -598,20 +688,52 @@ def load_fit_collection_into_data_frame(collection):
     return data_frame
 
 
-def get_configuration_set_from_command_line_args(command_line_args):
+def get_command_line_args(command_line_args):
     parser = argparse.ArgumentParser(description='Process Garmin FIT files')
     parser.add_argument('-c', nargs=1, required=True, type=ascii,
                         help='The command line set that should be selected from settings.json')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the decode workers with cProfile and merge the results')
+    parser.add_argument('--profile-sample', type=int, default=1, metavar='N',
+                        help='Profile 1 in N fit files. Defaults to every file')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='Also record peak tracemalloc allocation per profiled file')
+    parser.add_argument('--profile-directory', default='profile',
+                        help='Directory where worker and merged profiles are written')
+
+    args = parser.parse_args(command_line_args)
+    return args
 
-    args = parser.parse_args()
+
+def get_configuration_set_from_command_line_args(args):
     configuration_set = args.c[0][1:len(args.c[0])-1]
     return configuration_set
 
 
+def get_profile_options_from_command_line_args(args):
+    if not args.profile:
+        return None
+    if args.profile_sample < 1:
+        logging.error('Invalid profile sample %s. Profiling every file', args.profile_sample)
+        args.profile_sample = 1
+    return dict(directory=args.profile_directory,
+                sample=args.profile_sample,
+                memory=args.profile_memory)
+
+
+def init_worker(configuration_set, record_queue):
+    global worker_configuration_set, worker_record_queue
+    worker_configuration_set = configuration_set
+    worker_record_queue = record_queue
+
+
 def process_fit_file(file):
     activity_id = extract_activity_id_from_file_name(file)
-    settings = get_settings('full')
-    db = connect_to_mongo(settings)
+    settings = get_settings(worker_configuration_set)
+    if settings['db_insert'] == SQLITE:
+        record_buffer = sqlite_sink.SqliteRecordBuffer(worker_record_queue)
+    else:
+        db = connect_to_mongo(settings)
 
     record_id = 0
     with fitdecode.FitReader(settings["directory"] + '/' + file) as fit:
@@ -658,18 +780,47 @@ def process_fit_file(file):
                     db[settings['collection_name']].insert_one(db_activity)
             elif settings['db_insert'] == FULL:
                 db[settings['collection_name']].insert_one(full_activity)
+            elif settings['db_insert'] == SQLITE:
+                if isinstance(frame, fitdecode.FitDefinitionMessage):
+                    record_buffer.add_definition(frame.name, process_FieldDefinition_list_for_sqlite(frame.field_defs))
+                elif isinstance(frame, fitdecode.FitDataMessage):
+                    record_buffer.add_row(frame.name, db_activity)
             else:
                 logging.error("Unknown db_insert_setting %s", settings['db_insert'])
+
+    if settings['db_insert'] == SQLITE:
+        record_buffer.flush()
     print('Processed File', file)
-    return
+    return activity_id
+
+
+def process_fit_file_with_profile(file, profile_file, profile_options):
+    if profile_file:
+        return profiling.profile_fit_file(process_fit_file, file, profile_options)
+    return process_fit_file(file)
+
+
+def wait_for_pool(async_result, writer):
+    """
+    Waits for the pool results.  When the SQLite writer stops early the workers would block on the full
+    queue, so the wait is abandoned and the pool terminated by the caller.
+    :param async_result: result of pool.map_async or pool.starmap_async
+    :param writer: SQLite writer process or None
+    :return: list of results from the workers
+    """
+    while not async_result.ready():
+        async_result.wait(1)
+        if writer is not None and not writer.is_alive() and not async_result.ready():
+            raise RuntimeError('SQLite writer stopped with exit code ' + str(writer.exitcode))
+    return async_result.get()
 
 
 def main(command_line_args):
     configure_logging()
-    configuration_set = get_configuration_set_from_command_line_args(command_line_args)
+    command_line = get_command_line_args(command_line_args)
+    configuration_set = get_configuration_set_from_command_line_args(command_line)
+    profile_options = get_profile_options_from_command_line_args(command_line)
     settings = get_settings(configuration_set)
-    db = connect_to_mongo(settings)
-    reset_db(settings, db)
 
     files = os.listdir(settings["directory"])
     if 'activity_ids' in settings:
@@ -679,9 +830,43 @@ def main(command_line_args):
 
     fit_file_count = 0
 
+    if profile_options:
+        profiling.prepare_profile_directory(profile_options)
+
+    record_queue = None
+    writer = None
+    if settings['db_insert'] == SQLITE:
+        # a single writer process owns the database, the workers send it their rows
+        record_queue = mp.SimpleQueue()
+        writer = mp.Process(target=sqlite_sink.write_records, args=(record_queue, settings))
+        writer.start()
+    else:
+        start_ingest_manifest(settings, time.time())
+        db = connect_to_mongo(settings)
+        reset_db(settings, db)
+
     start_time = time.time()
-    with mp.Pool(32) as pool:
-        results = pool.map(process_fit_file, fit_files, chunksize=100)
+    async_result = None
+    try:
+        with mp.Pool(32, initializer=init_worker, initargs=(configuration_set, record_queue)) as pool:
+            if profile_options:
+                file_args = [(file, index % profile_options['sample'] == 0, profile_options)
+                             for index, file in enumerate(fit_files)]
+                async_result = pool.starmap_async(process_fit_file_with_profile, file_args, chunksize=100)
+            else:
+                async_result = pool.map_async(process_fit_file, fit_files, chunksize=100)
+            results = wait_for_pool(async_result, writer)
+    finally:
+        # the writer must always be stopped, otherwise it blocks the exit.  A failed map is only ready
+        # once every task has finished, so the workers were idle when the pool was terminated.
+        if writer is not None:
+            pool_completed = async_result is not None and async_result.ready()
+            writer_exitcode = sqlite_sink.stop_writer(record_queue, writer, pool_completed)
+
+    if writer is not None and writer_exitcode != 0:
+        logging.error('SQLite writer exited with code %s', writer_exitcode)
+        print('SQLite writer failed with exit code', writer_exitcode)
+        sys.exit(1)
 
     # for file in fit_files:
     #     fit_file_count += 1
@@ -697,6 +882,13 @@ def main(command_line_args):
 
     print('The total duration is ', str(duration))
 
+    # the query cache only reads MongoDB, a SQLite load does not change what it caches
+    if settings['db_insert'] != SQLITE:
+        write_ingest_manifest(settings, [activity_id for activity_id in results if activity_id], end_time)
+
+    if profile_options:
+        profiling.merge_worker_profiles(profile_options)
+
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,199 @@
+#####################################################################################################
+# Profiling support for the FIT decoding program.
+#
+# The decode work runs inside the mp.Pool children started by main.py, so a profiler attached to
+# the parent process sees nothing useful.  When main.py is started with --profile each worker
+# runs cProfile (and optionally tracemalloc) around process_fit_file and writes its own stats
+# into the profile directory.  Once the pool finishes, the parent merges those files into:
+#
+#   hotspots.txt        - merged cProfile stats sorted by cumulative and internal time
+#   merged.prof         - merged pstats file that can be loaded with pstats or snakeviz
+#   profile.collapsed   - collapsed stacks that can be fed to flamegraph.pl or speedscope
+#   memory_peaks.tsv    - peak traced allocation per file (only with --profile-memory)
+#
+# cProfile only records caller/callee pairs, not full stacks, so the collapsed stacks are rebuilt
+# from those pairs and the time of a function is split across its callers in proportion to the
+# time each caller spent in it.  This is the same approximation gprof2dot uses.
+#
+# Profiling every file of a full run is expensive.  --profile-sample N profiles 1 file in N.
+###############################################################################################
+
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import tracemalloc
+
+WORKER_PROFILE_PREFIX = 'worker_'
+WORKER_MEMORY_PREFIX = 'memory_'
+COLLAPSED_MAX_DEPTH = 64
+
+# One profiler per worker process.  It is enabled only while a sampled file is processed so the
+# stats dumped by the worker cover every file it profiled.
+_worker_profiler = None
+
+
+def profile_fit_file(process_function, file, profile_options):
+    """
+    Runs process_function(file) under cProfile and optionally tracemalloc.  The accumulated stats of
+    the worker are rewritten after each file so they survive the pool terminating its children.
+    :param process_function: function that processes one fit file
+    :param file: fit file name passed to process_function
+    :param profile_options: dict with directory and memory keys
+    :return: result of process_function
+    """
+    global _worker_profiler
+    if _worker_profiler is None:
+        _worker_profiler = cProfile.Profile()
+
+    # tracemalloc runs only for the sampled file so unsampled files keep their full speed and
+    # allocations kept from earlier files are not counted in this file's peak
+    if profile_options['memory']:
+        tracemalloc.start()
+
+    _worker_profiler.enable()
+    try:
+        result = process_function(file)
+    finally:
+        _worker_profiler.disable()
+        pid = str(os.getpid())
+        _worker_profiler.dump_stats(os.path.join(profile_options['directory'],
+                                                 WORKER_PROFILE_PREFIX + pid + '.prof'))
+
+        if profile_options['memory']:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            logging.info('Peak traced allocation for %s is %d bytes', file, peak)
+            with open(os.path.join(profile_options['directory'], WORKER_MEMORY_PREFIX + pid + '.tsv'), 'a') as f:
+                f.write(file + '\t' + str(peak) + '\n')
+    return result
+
+
+def prepare_profile_directory(profile_options):
+    """
+    Creates the profile directory and removes worker files left by a previous run so they are not
+    merged into this one.
+    """
+    os.makedirs(profile_options['directory'], exist_ok=True)
+    for prefix, extension in ((WORKER_PROFILE_PREFIX, '.prof'), (WORKER_MEMORY_PREFIX, '.tsv')):
+        for stale_file in glob.glob(os.path.join(profile_options['directory'], prefix + '*' + extension)):
+            os.remove(stale_file)
+
+
+def merge_worker_profiles(profile_options, report_limit=50):
+    """
+    Merges the per-worker stats written by profile_fit_file into one report.
+    :param profile_options: dict with directory and memory keys
+    :param report_limit: number of functions listed in each section of hotspots.txt
+    :return: merged pstats.Stats or None when no worker wrote stats
+    """
+    directory = profile_options['directory']
+    worker_files = sorted(glob.glob(os.path.join(directory, WORKER_PROFILE_PREFIX + '*.prof')))
+    if not worker_files:
+        logging.error('merge_worker_profiles(): No worker profiles found in %s', directory)
+        return None
+
+    with open(os.path.join(directory, 'hotspots.txt'), 'w') as report:
+        stats = pstats.Stats(*worker_files, stream=report)
+        stats.dump_stats(os.path.join(directory, 'merged.prof'))
+        stats.strip_dirs()
+        report.write('Merged profile of ' + str(len(worker_files)) + ' workers\n\n')
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(report_limit)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(report_limit)
+
+    write_collapsed_stacks(stats, os.path.join(directory, 'profile.collapsed'))
+
+    if profile_options['memory']:
+        merge_memory_peaks(directory)
+
+    print('Profile written to', directory)
+    return stats
+
+
+def merge_memory_peaks(directory):
+    peaks = []
+    for memory_file in glob.glob(os.path.join(directory, WORKER_MEMORY_PREFIX + '*.tsv')):
+        with open(memory_file, 'r') as f:
+            for line in f:
+                file, peak = line.rstrip('\n').split('\t')
+                peaks.append((int(peak), file))
+
+    peaks.sort(reverse=True)
+    with open(os.path.join(directory, 'memory_peaks.tsv'), 'w') as f:
+        f.write('file\tpeak_bytes\n')
+        for peak, file in peaks:
+            f.write(file + '\t' + str(peak) + '\n')
+
+
+def format_function_label(function):
+    file_name, line, name = function
+    if file_name == '~':
+        # built-in functions have no source location
+        return name.replace(';', ':')
+    return (name + ' (' + os.path.basename(file_name) + ':' + str(line) + ')').replace(';', ':')
+
+
+def write_collapsed_stacks(stats, collapsed_file_name):
+    """
+    Writes flamegraph collapsed stacks ("root;child;leaf microseconds") rebuilt from the caller/callee
+    pairs in stats.  A callee's share of each call path is the time spent in it from that caller over the
+    time spent in it from all of its callers.  Paths that recurse, go past COLLAPSED_MAX_DEPTH or carry
+    less than a microsecond are not followed, so each function's self time is scaled by the share that
+    did reach it.  Functions no path reaches become their own root.  This keeps the collapsed total equal
+    to the total time of stats.
+    :return: total of the collapsed stacks in microseconds
+    """
+    callees = {}
+    roots = []
+    for function, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append(function)
+        for caller in callers:
+            callees.setdefault(caller, []).append(function)
+
+    visits = []
+    reached_share = {}
+
+    def visit(function, path, share):
+        path = path + (function,)
+        visits.append((path, share))
+        reached_share[function] = reached_share.get(function, 0) + share
+        if len(path) >= COLLAPSED_MAX_DEPTH:
+            return
+        for callee in callees.get(function, []):
+            if callee in path:
+                continue
+            callee_callers = stats.stats[callee][4]
+            callers_ct = sum(edge[3] for edge in callee_callers.values())
+            if callers_ct <= 0:
+                continue
+            callee_share = share * callee_callers[function][3] / callers_ct
+            if callee_share * callers_ct * 1000000 >= 1:
+                visit(callee, path, callee_share)
+
+    for root in roots:
+        visit(root, (), 1.0)
+    for function in stats.stats:
+        if function not in reached_share:
+            visit(function, (), 1.0)
+
+    collapsed = {}
+    for path, share in visits:
+        self_time = stats.stats[path[-1]][2] * share / reached_share[path[-1]] * 1000000
+        key = ';'.join(format_function_label(function) for function in path)
+        collapsed[key] = collapsed.get(key, 0) + self_time
+
+    collapsed_total = 0
+    with open(collapsed_file_name, 'w') as f:
+        for key in sorted(collapsed):
+            self_time = int(round(collapsed[key]))
+            if self_time > 0:
+                f.write(key + ' ' + str(self_time) + '\n')
+                collapsed_total += self_time
+
+    # each written line is rounded to the nearest microsecond
+    if abs(collapsed_total - stats.total_tt * 1000000) > len(collapsed):
+        logging.error('write_collapsed_stacks(): Collapsed total %d us does not match profile total %d us',
+                      collapsed_total, stats.total_tt * 1000000)
+    return collapsed_total
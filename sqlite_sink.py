@@ -0,0 +1,259 @@
+#####################################################################################################
+# Embedded SQLite output for the FIT decoding program.
+#
+# Setting db_insert to "sqlite" writes the decoded data messages to a local SQLite database instead
+# of MongoDB so no database server is needed.  Each message type (record, session, lap, ...) gets its
+# own table.  Column types come from the field types of the definition messages, the same types
+# process_FieldDefinition_list_for_db() adds to the Mongo definition records, except that fields
+# fitdecode scales or offsets and the positions process_value() converts to degrees are REAL.  The
+# 'None' string process_value() writes for a missing position is stored as NULL.  Unsigned 64 bit
+# fields are TEXT so values above the SQLite INTEGER range stay exact.  Columns that are not in a
+# definition, such as activity_id, record_id or the expanded name_1, name_2 array values, take their
+# type from the first value seen.
+#
+# The decode workers do not write to the database.  They buffer their rows with SqliteRecordBuffer
+# and put them on a multiprocessing SimpleQueue read by a single writer process running write_records().
+# SimpleQueue writes straight to the pipe, so a worker blocks while the writer is behind and its rows
+# are in the pipe before its task completes.  The writer inserts with executemany inside large
+# transactions.  Indexes from an earlier load are dropped first and all indexes are created once the
+# load finishes.
+#
+# The following optional settings control the output.
+# sqlite_file - location of the database file.  Defaults to "fit.sqlite".
+# sqlite_batch_size - number of rows inserted per transaction.  Defaults to 100000.
+###############################################################################################
+
+import json
+import logging
+import sqlite3
+import threading
+
+DEFAULT_SQLITE_FILE = 'fit.sqlite'
+DEFAULT_BATCH_SIZE = 100000
+WORKER_BATCH_SIZE = 5000
+MAX_INTEGER = 2 ** 63 - 1
+
+INTEGER_TYPES = {'bool', 'sint8', 'uint8', 'uint8z', 'sint16', 'uint16', 'uint16z', 'sint32', 'uint32', 'uint32z',
+                 'sint64'}
+REAL_TYPES = {'float32', 'float64', 'scaled'}
+DEGREE_FIELDS = {'position_lat', 'position_long'}
+# unsigned 64 bit values can be larger than an SQLite INTEGER and are stored as exact decimal text
+TEXT_TYPES = {'enum', 'string', 'date_time', 'local_date_time', 'uint64', 'uint64z'}
+
+
+class SqliteRecordBuffer:
+    """
+    Collects the rows of one fit file inside a decode worker and sends them to the writer process
+    in batches of WORKER_BATCH_SIZE rows.
+    """
+
+    def __init__(self, record_queue):
+        self.record_queue = record_queue
+        self.field_types = {}
+        self.rows = {}
+        self.row_count = 0
+
+    def add_definition(self, message_name, field_types):
+        """
+        :param message_name: name of the message the definition describes
+        :param field_types: field name to type dict from process_FieldDefinition_list_for_db()
+        """
+        self.field_types.setdefault(message_name, {}).update(field_types)
+
+    def add_row(self, message_name, row):
+        self.rows.setdefault(message_name, []).append(row)
+        self.row_count += 1
+        if self.row_count >= WORKER_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.row_count:
+            self.record_queue.put((self.field_types, self.rows))
+        self.rows = {}
+        self.row_count = 0
+
+
+def quote_name(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def get_column_type(column, field_type, value):
+    if column in DEGREE_FIELDS:
+        return 'REAL'
+    if field_type in INTEGER_TYPES:
+        return 'INTEGER'
+    if field_type in REAL_TYPES:
+        return 'REAL'
+    if field_type in TEXT_TYPES:
+        return 'TEXT'
+    if field_type == 'byte':
+        return 'BLOB'
+
+    # not in a definition, use the value
+    if isinstance(value, int) and not isinstance(value, bool) and abs(value) > MAX_INTEGER:
+        return 'TEXT'
+    if isinstance(value, (bool, int)):
+        return 'INTEGER'
+    if isinstance(value, float):
+        return 'REAL'
+    if isinstance(value, bytes):
+        return 'BLOB'
+    return 'TEXT'
+
+
+def adapt_value(value):
+    if value == 'None':
+        return None
+    if isinstance(value, int) and not isinstance(value, bool) and abs(value) > MAX_INTEGER:
+        # exact in a TEXT column.  An INTEGER column created from a smaller first value converts it to REAL.
+        logging.debug('adapt_value(): %d does not fit an SQLite INTEGER, stored as text', value)
+        return str(value)
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, default=str)
+    return value
+
+
+def open_database(settings):
+    connection = sqlite3.connect(settings.get('sqlite_file', DEFAULT_SQLITE_FILE))
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+
+    if settings['reloadDB']:
+        tables = [row[0] for row in
+                  connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+        with connection:
+            for table in tables:
+                connection.execute('DROP TABLE ' + quote_name(table))
+    return connection
+
+
+def get_table_columns(connection):
+    table_columns = {}
+    tables = [row[0] for row in
+              connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+    for table in tables:
+        table_columns[table] = {row[1].lower() for row in
+                                connection.execute('PRAGMA table_info(' + quote_name(table) + ')')}
+    return table_columns
+
+
+def add_columns(connection, table_columns, table, row, field_types):
+    """
+    Creates the table or adds the columns of row that the table does not have yet.  SQLite column names
+    are not case sensitive so table_columns holds lower case names.
+    """
+    if table not in table_columns:
+        columns = [quote_name(column) + ' ' + get_column_type(column, field_types.get(column), value)
+                   for column, value in row.items()]
+        connection.execute('CREATE TABLE ' + quote_name(table) + ' (' + ', '.join(columns) + ')')
+        table_columns[table] = {column.lower() for column in row}
+        return
+
+    for column, value in row.items():
+        if column.lower() not in table_columns[table]:
+            connection.execute('ALTER TABLE ' + quote_name(table) + ' ADD COLUMN ' + quote_name(column) + ' ' +
+                               get_column_type(column, field_types.get(column), value))
+            table_columns[table].add(column.lower())
+
+
+def flush_rows(connection, pending_rows):
+    with connection:
+        for (table, columns), rows in pending_rows.items():
+            connection.executemany('INSERT INTO ' + quote_name(table) +
+                                   ' (' + ', '.join(quote_name(column) for column in columns) + ')' +
+                                   ' VALUES (' + ', '.join('?' * len(columns)) + ')', rows)
+
+
+def drop_indexes(connection):
+    """
+    Drops the indexes created by an earlier load so the inserts of an appending load do not update them.
+    create_indexes() builds them again at the end.
+    """
+    indexes = [row[0] for row in
+               connection.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'ix\\_%' ESCAPE '\\'")]
+    with connection:
+        for index in indexes:
+            connection.execute('DROP INDEX ' + quote_name(index))
+
+
+def create_indexes(connection, table_columns):
+    with connection:
+        for table, columns in table_columns.items():
+            if 'activity_id' in columns and 'record_id' in columns:
+                connection.execute('CREATE INDEX IF NOT EXISTS ' + quote_name('ix_' + table + '_activity') +
+                                   ' ON ' + quote_name(table) + ' (activity_id, record_id)')
+            if 'timestamp' in columns:
+                connection.execute('CREATE INDEX IF NOT EXISTS ' + quote_name('ix_' + table + '_timestamp') +
+                                   ' ON ' + quote_name(table) + ' (timestamp)')
+
+
+def write_records(record_queue, settings):
+    """
+    Writer process.  Reads (field_types, rows) batches from record_queue until None is received.
+    :param record_queue: multiprocessing SimpleQueue filled by SqliteRecordBuffer
+    :param settings: settings loaded with get_settings()
+    """
+    try:
+        load_records(record_queue, settings)
+    except Exception:
+        logging.exception('write_records(): SQLite writer failed')
+        raise
+
+
+def load_records(record_queue, settings):
+    batch_size = int(settings.get('sqlite_batch_size', DEFAULT_BATCH_SIZE))
+    connection = open_database(settings)
+    table_columns = get_table_columns(connection)
+    drop_indexes(connection)
+    checked_columns = set()
+    pending_rows = {}
+    pending_count = 0
+    row_total = 0
+
+    while True:
+        batch = record_queue.get()
+        if batch is None:
+            break
+
+        field_types, rows = batch
+        for table, table_rows in rows.items():
+            for row in table_rows:
+                columns = tuple(row)
+                if (table, columns) not in checked_columns:
+                    add_columns(connection, table_columns, table, row, field_types.get(table, {}))
+                    checked_columns.add((table, columns))
+                pending_rows.setdefault((table, columns), []).append(tuple(adapt_value(value)
+                                                                           for value in row.values()))
+            pending_count += len(table_rows)
+
+        if pending_count >= batch_size:
+            flush_rows(connection, pending_rows)
+            row_total += pending_count
+            pending_rows = {}
+            pending_count = 0
+
+    flush_rows(connection, pending_rows)
+    row_total += pending_count
+    create_indexes(connection, table_columns)
+    connection.close()
+    logging.info('write_records(): Inserted %d rows into %d tables', row_total, len(table_columns))
+
+
+def stop_writer(record_queue, writer, pool_completed):
+    """
+    Sends the end of input marker to the writer process and waits for it to finish.  Called from the
+    parent process whether or not the pool completed.
+    :param pool_completed: False when the pool was terminated.  A worker may have been killed part way
+                           through a put, so the writer is terminated instead of being sent the marker.
+    :return: exit code of the writer process
+    """
+    if pool_completed:
+        # the put blocks while the pipe is full, do not wait on it if the writer dies
+        sender = threading.Thread(target=record_queue.put, args=(None,), daemon=True)
+        sender.start()
+        while sender.is_alive() and writer.is_alive():
+            sender.join(1)
+    elif writer.is_alive():
+        writer.terminate()
+    writer.join()
+    return writer.exitcode